@@ -15,8 +15,12 @@ from __future__ import print_function, absolute_import
 ###############################################################
 
 #Python Libraries
-import os, sys, time, shutil
+import os, sys, time, shutil, io, traceback, copy
+import multiprocessing
 from glob import glob
+from contextlib import redirect_stdout
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 import numpy as np
 from optparse import OptionParser
 
@@ -46,6 +50,13 @@ metals = ["Li","Be","Na","Mg","Al","K","Ca","Sc","Ti","V","Cr","Mn","Fe","Co","N
 	"Hf","Ta","W","Re","Os","Ir","Pt","Au","Hg","Tl","Pb","Bi","Po","Fr","Ra","Ac","Th","Pa","U","Np","Pu","Am","Cm","Bk","Cf",
 	"Es","Fm","Md","No","Lr","Rf","Db","Sg","Bh","Hs","Mt","Ds","Rg","Cn","Uut","Fl","Uup","Lv"]
 
+# lookup tables built once at import and shared by every file processed - treat them as read-only
+_METALS_SET = frozenset(metals)
+_PT_SET = frozenset(periodictable)
+_VDW_SET = frozenset(bondi) | _PT_SET
+# elements without a tabulated Bondi radius are given 2.0A
+bondi_radii = np.vectorize(lambda atom: bondi.get(atom, 2.0), otypes=[np.float64])
+
 isovals = {"Bq": 0.00, "H": .00475}
 BOHR_TO_ANG = 0.529177249
 
@@ -58,7 +69,7 @@ class dbstep:
 			grid, onehot_grid, unocc_grud
 			L, Bmax, Bmin, 
 			occ_vol, bur_vol, bur_shell
-			setup_time, calc_time
+			setup_time, calc_time (only if timing is requested)
 
 	If steric scan is requested, Bmin and Bmax variables
 	contain lists of params along scan
@@ -77,8 +88,10 @@ class dbstep:
 		self.setup_time, self.calc_time = False, False
 		
 		
+		# options are adjusted to the molecule being read (atom numbering, surface type, grid spacing),
+		# so each calculation works on its own copy and nothing is carried over to the next file
 		if 'options' in kwargs:
-			self.options = kwargs['options']
+			self.options = copy.deepcopy(kwargs['options'])
 		else:
 			self.options = set_options(kwargs)
 		if 'QSAR' in kwargs:
@@ -88,62 +101,55 @@ class dbstep:
 		file = self.file
 		options = self.options
 
-		start = time.time()
+		# timings are only collected when requested
+		if options.timing: start = time.perf_counter()
 		spheres, cylinders = [], []
 		if isinstance(file,str):
 			name, ext = os.path.splitext(file)
 		else:
 			name = file
 			ext = 'rdkit'
+		# pymol objects (and the cube file they display) are only written if new files are requested
+		pymol_output = options.commandline == False and ext != 'rdkit'
 			
 		r_intervals, origin = 1, np.array([0,0,0])
 		
 		# if atoms are not specified upon input, grab first and second atom in file
-		# allow for multiple ways to specify atoms (H1 or just 1)
-		if options.spec_atom_1 == False:
-			options.spec_atom_1 = 1
-		else: 
-			try: 
-				options.spec_atom_1 = int(options.spec_atom_1) 
-			except:
-				options.spec_atom_1 = int(''.join([s for s in options.spec_atom_1 if s.isdigit()]))
-		#set default for atom 2
-		if options.spec_atom_2 == False:
-			options.spec_atom_2 = [2]
-		else:
-			try:
-				#check if int was supplied
-				options.spec_atom_2 = [int(options.spec_atom_2)]
-			except: 
-				#check for multiple atoms supplied
-				if ',' in options.spec_atom_2:
-					try: 
-						#list of ints supplied
-						options.spec_atom_2 = [int(s) for s in options.spec_atom_2.split(',') if s.isdigit()]
-					except: 
-						#atoms and atom types supplied
-						atom2_id = []
-						for i in options.spec_atom_2.split(','):
-							atom2_id.append([int(x) for x in s if x.isdigit()][0])
-				elif isinstance(options.spec_atom_2,list):
-					pass
-				else:
-					#single atom and atom type supplied
-					options.spec_atom_2 = [int(''.join([s for s in options.spec_atom_2 if s.isdigit()]))]
+		# allow for multiple ways to specify atoms (H1 or just 1), atom types are checked once the molecule is read
+		try:
+			if options.spec_atom_1 == False:
+				atom1_type, options.spec_atom_1 = '', 1
+			else: 
+				atom1_type, options.spec_atom_1 = parse_data.atom_label(options.spec_atom_1)
+			#set default for atom 2
+			if options.spec_atom_2 == False:
+				atom2_types, options.spec_atom_2 = [''], [2]
+			elif isinstance(options.spec_atom_2,list):
+				atom2_types = [parse_data.atom_label(spec)[0] for spec in options.spec_atom_2]
+				options.spec_atom_2 = [parse_data.atom_label(spec)[1] for spec in options.spec_atom_2]
+			else:
+				#one or more atoms supplied as numbers (3) or with atom types (C3), separated by commas
+				labels = [parse_data.atom_label(spec) for spec in str(options.spec_atom_2).split(',')]
+				atom2_types, options.spec_atom_2 = [label[0] for label in labels], [label[1] for label in labels]
+			#optional third atom used to fix the rotation about the Z-axis
+			atom3_types, atom3_ids = [], []
+			if options.atom3 != False:
+				atom3_type, atom3_id = parse_data.atom_label(options.atom3)
+				atom3_types, atom3_ids = [atom3_type], [atom3_id]
+		except ValueError as e:
+			sys.exit("   "+str(e))
 			 
 		#Parse coordinate/volumetric information
 		if ext == '.cube':
 			options.surface = 'density'
 			mol = parse_data.GetCubeData(name)
-		elif ext == 'rdkit':
-			mol = parse_data.GetData_RDKit(name, options.noH, options.spec_atom_1, options.spec_atom_2)
-		elif ext == ".xyz":
-			mol = parse_data.GetXYZData(name, ext, options.noH,options.spec_atom_1, options.spec_atom_2)
-			if options.noH:
-				options.spec_atom_1 = mol.spec_atom_1
-				options.spec_atom_2 = mol.spec_atom_2
 		else:
-			mol = parse_data.GetData_cclib(name, ext, options.noH,options.spec_atom_1, options.spec_atom_2)
+			if ext == 'rdkit':
+				mol = parse_data.GetData_RDKit(name, options.noH, options.spec_atom_1, options.spec_atom_2)
+			elif ext == ".xyz":
+				mol = parse_data.GetXYZData(name, ext, options.noH,options.spec_atom_1, options.spec_atom_2)
+			else:
+				mol = parse_data.GetData_cclib(name, ext, options.noH,options.spec_atom_1, options.spec_atom_2)
 			if options.noH:
 				options.spec_atom_1 = mol.spec_atom_1
 				options.spec_atom_2 = mol.spec_atom_2
@@ -154,6 +160,17 @@ class dbstep:
 			else:
 				sys.exit("One or zero atoms found in "+file+" - Please try again with a different input file.")
 		
+		# keep coordinates as a contiguous (N,3) float array with a parallel array of atom types
+		mol.CARTESIANS = np.ascontiguousarray(mol.CARTESIANS, dtype=np.float64).reshape(-1, 3)
+		mol.ATOMTYPES = np.asarray(mol.ATOMTYPES)
+		
+		# check that any atom types given with the atom numbers match the molecule
+		for atom_type, atom_id in zip([atom1_type] + atom2_types + atom3_types, [options.spec_atom_1] + options.spec_atom_2 + atom3_ids):
+			if atom_id < 1 or atom_id > len(mol.ATOMTYPES):
+				sys.exit("   Atom {} is not present in {}".format(atom_id, file))
+			if atom_type and atom_type != mol.ATOMTYPES[atom_id-1]:
+				sys.exit("   Atom {} in {} is {}, not {}".format(atom_id, file, mol.ATOMTYPES[atom_id-1], atom_type))
+		
 		#flag volume if buried shell requested
 		if options.vshell: options.volume = True
 		#if measuring volume, need to measure from grid
@@ -174,20 +191,12 @@ class dbstep:
 		#surfaces can either be formed from Van der Waals (bondi) radii (=vdw) or cube densities (=density)
 		if options.surface == 'vdw':
 			# generate Bondi radii from atom types
-			try:
-				mol.RADII = [bondi[atom] for atom in mol.ATOMTYPES]
-				if options.verbose: print("   Defining the molecule with Bondi atomic radii scaled by {}".format(options.SCALE_VDW))
-			except:
-				mol.RADII = []
-				for atom in mol.ATOMTYPES:
-					if atom not in periodictable:
-						print("\n   UNABLE TO GENERATE VDW RADII FOR ATOM: ", atom); exit()
-					elif atom not in bondi:
-						mol.RADII.append(2.0)
-					else:
-						mol.RADII.append(bondi[atom])
+			for atom in set(mol.ATOMTYPES) - _VDW_SET:
+				print("\n   UNABLE TO GENERATE VDW RADII FOR ATOM: ", atom); exit()
+			if options.verbose: print("   Defining the molecule with Bondi atomic radii scaled by {}".format(options.SCALE_VDW))
 			# scale radii by a factor
-			mol.RADII = np.array(mol.RADII) * options.SCALE_VDW
+			mol.RADII = bondi_radii(np.asarray(mol.ATOMTYPES)) * options.SCALE_VDW
+			mol.RADII_SQ = mol.RADII ** 2
 		elif options.surface == 'density':
 			if hasattr(mol, 'DENSITY'):
 				mol.DENSITY = np.array(mol.DENSITY)
@@ -203,12 +212,13 @@ class dbstep:
 			print("   Requested surface {} is not currently implemented. Try either vdw or density".format(options.surface)); exit()
 
 		# Translate molecule to place atom1 at the origin
-		if options.surface == 'vdw' and options.sterimol or options.volume:
+		if options.surface == 'vdw' and (options.sterimol or options.volume):
 			mol.CARTESIANS = calculator.translate_mol(mol, options, origin)
 		elif options.surface == 'density':
 			[mol.CARTESIANS,mol.ORIGIN, x_min, x_max, y_min, y_max, z_min, z_max, xyz_max] = calculator.translate_dens(mol, options, x_min, x_max, y_min, y_max, z_min, z_max, xyz_max, origin)
 		
 		# if computing sterimol parameters: rotate molecule and compute 
+		rotation = None
 		if options.sterimol:
 			# Check if we want to calculate parameters for mono- bi- or tridentate ligand
 			spec_atom_2 = ''
@@ -220,7 +230,10 @@ class dbstep:
 				if options.surface == 'vdw':
 					mol.CARTESIANS = calculator.rotate_mol(mol.CARTESIANS, mol.ATOMTYPES, options.spec_atom_1, point, options)
 				elif options.surface == 'density':
-					mol.CARTESIANS, mol.INCREMENTS = calculator.rotate_mol(mol.CARTESIANS, mol.ATOMTYPES, options.spec_atom_1,  point, options, cube_origin=mol.ORIGIN, cube_inc=mol.INCREMENTS)
+					# the density lattice is not moved, its occupied points are rotated by occupied_dens with the same matrix
+					rotation = calculator.rotation_matrix(mol.CARTESIANS, mol.ATOMTYPES, options.spec_atom_1, point, options)
+					mol.CARTESIANS = np.round(mol.CARTESIANS @ rotation.T, 8)
+					mol.ORIGIN, mol.INCREMENTS = mol.ORIGIN @ rotation.T, mol.INCREMENTS @ rotation.T
 
 		# Remove metals from the steric analysis. This is done by default and can be switched off by --addmetals
 		# This can't be done for densities
@@ -228,22 +241,22 @@ class dbstep:
 			
 			# Find maximum horizontal and vertical directions (coordinates + vdw) in which the molecule is fully contained
 			# First remove any atoms that have been requested to be removed from the analysis
+			# atoms to be kept are flagged in a mask so that each array is only sliced once
+			keep = np.ones(len(mol.ATOMTYPES), dtype=bool)
 			if options.exclude != False:
-				del_atom_list = [int(atom) for atom in options.exclude.split(',')]
-				for del_atom in sorted(del_atom_list, reverse=True):
+				for del_atom in options.exclude.split(','):
 					try:
-						mol.ATOMTYPES = np.delete(mol.ATOMTYPES,del_atom-1)
-						mol.CARTESIANS = np.delete(mol.CARTESIANS,del_atom-1, axis=0)
-						mol.RADII = np.delete(mol.RADII,del_atom-1)
+						keep[int(del_atom)-1] = False
 					except:
 						print("   WARNING! Unable to remove the atoms requested")
-			
+
 			#remove metals
-			for i, atom in enumerate(mol.ATOMTYPES):
-				if atom in metals and options.add_metals == False:
-					mol.ATOMTYPES = np.delete(mol.ATOMTYPES,i)
-					mol.CARTESIANS = np.delete(mol.CARTESIANS,i, axis=0)
-					mol.RADII = np.delete(mol.RADII,i)
+			if options.add_metals == False:
+				keep &= np.array([atom not in _METALS_SET for atom in mol.ATOMTYPES], dtype=bool)
+			mol.ATOMTYPES = np.asarray(mol.ATOMTYPES)[keep]
+			mol.CARTESIANS = np.asarray(mol.CARTESIANS)[keep]
+			mol.RADII = mol.RADII[keep]
+			mol.RADII_SQ = mol.RADII_SQ[keep]
 
 			#determine grid size based on molecule vdw radii and radius selected for buried vol
 			[x_min, x_max, y_min, y_max, z_min, z_max, xyz_max] = sterics.max_dim(mol.CARTESIANS, mol.RADII, options)
@@ -296,13 +309,12 @@ class dbstep:
 				z_vals = np.linspace(z_min, z_max, n_z_vals)
 			
 			if options.measure == 'grid':
-				# construct grid encapsulating molecule
-				grid = np.array(np.meshgrid(x_vals, y_vals, z_vals)).T.reshape(-1,3)
-				# compute which grid points occupy molecule
+				# compute which points of the grid encapsulating the molecule are occupied, the full grid is only built for QSAR
 				if options.qsar:
-					occ_grid, unocc_grid, onehot_grid, point_tree, occ_vol = sterics.occupied(grid, mol.CARTESIANS, mol.RADII, origin, options)
+					grid = sterics.make_grid(x_vals, y_vals, z_vals)
+					occ_grid, unocc_grid, onehot_grid, occ_vol = sterics.occupied((x_vals, y_vals, z_vals), mol.CARTESIANS, mol.RADII, origin, options, mol.RADII_SQ)
 				else:
-					occ_grid, point_tree, occ_vol = sterics.occupied(grid, mol.CARTESIANS, mol.RADII, origin, options)
+					occ_grid, occ_vol = sterics.occupied((x_vals, y_vals, z_vals), mol.CARTESIANS, mol.RADII, origin, options, mol.RADII_SQ)
 
 			if options.qsar:
 				if options.verbose: print("\n   Creating interaction energy grid xyz files in 'grid_"+name+"' directory")
@@ -344,19 +356,17 @@ class dbstep:
 			x_vals = np.linspace(x_min, x_max, mol.xdim)
 			y_vals = np.linspace(y_min, y_max, mol.ydim)
 			z_vals = np.linspace(z_min, z_max, mol.zdim)
-			# writes a new grid to cube file
-			writer.WriteCubeData(name, mol)
-			# define the grid points containing the molecule
-			grid = np.array(np.meshgrid(x_vals, y_vals, z_vals)).T.reshape(-1,3)
-			# compute occupancy based on isodensity value applied to cube and remove points where there is no molecule
-			occ_grid,occ_vol = sterics.occupied_dens(grid, mol.DENSITY, options)
+			# writes a new grid to cube file, this is only read by the pymol script
+			if pymol_output: writer.WriteCubeData(name, mol)
+			# compute occupancy based on isodensity value applied to cube, only the points where there is molecule are kept
+			occ_grid,occ_vol = sterics.occupied_dens((x_vals, y_vals, z_vals), mol.DENSITY, options, rotation)
 			
 			#adjust sizing of grid to fit sphere if necessary
 			if options.volume:
-				grid = sterics.resize_grid(x_max,y_max,z_max,x_min,y_min,z_min,options,mol)
+				x_vals, y_vals, z_vals = sterics.resize_grid(x_max,y_max,z_max,x_min,y_min,z_min,options,mol)
 				
 		# Set up done so note the time
-		setup_time = time.time() - start
+		if options.timing: setup_time = time.perf_counter() - start
 		# message user
 		if options.verbose: print("\n   Steric parameters will be generated in {} mode for {}\n".format(options.measure, file))
 		
@@ -368,6 +378,21 @@ class dbstep:
 
 		Bmin_list, Bmax_list, bur_vol_list, bur_shell_list = [], [], [], []
 		
+		# distances of the occupied points from the origin are shared by all buried volume radii
+		if options.volume:
+			occ_dist_sq = sterics.occupied_dist_sq(occ_grid, origin)
+		
+		# for a grid Sterimol scan the occupied points are ordered by height once, so that each strip is found by binary search
+		z_order = None
+		if options.sterimol and options.measure == 'grid' and r_intervals > 1:
+			z_order = sterics.height_order(occ_grid)
+		
+		# classic Sterimol parameters don't depend on the radius, so they are only computed once for a scan
+		if options.sterimol and options.measure == 'classic':
+			if options.surface == 'density':
+				print("   Can't use classic Sterimol with the isodensity surface. Either use VDW radii (--surface vdw) or use grid Sterimol (--sterimol grid)"); exit()
+			classic_sterimol = sterics.get_classic_sterimol(mol.CARTESIANS, mol.RADII,mol.ATOMTYPES)
+		
 		#Measure Sterimol or Volume 
 		for rad in np.linspace(r_min, r_max, r_intervals):
 			# The buried volume is defined in terms of occupied voxels.
@@ -377,32 +402,28 @@ class dbstep:
 					bur_vol, bur_shell = 0.0,0.0
 				else:
 					if options.vshell: strip_width = options.vshell
-					bur_vol, bur_shell = sterics.buried_vol(occ_grid, point_tree, origin, rad, strip_width, options)
+					bur_vol, bur_shell = sterics.buried_vol(occ_grid, (x_vals, y_vals, z_vals), origin, rad, strip_width, options, occ_dist_sq)
 				bur_vol_list.append(bur_vol)
 				bur_shell_list.append(bur_shell)
 			# Sterimol parameters can be obtained from VDW radii (classic) or from occupied voxels (new=default)
 			if options.sterimol:
 				if options.measure == 'grid':
-					L, Bmax, Bmin, cyl = sterics.get_cube_sterimol(occ_grid, rad, options.grid, strip_width, options.pos)
+					L, Bmax, Bmin, cyl = sterics.get_cube_sterimol(occ_grid, rad, options.grid, strip_width, options.pos, z_order)
 				elif options.measure == 'classic':
-					if options.surface == 'vdw':
-						L, Bmax, Bmin, cyl = sterics.get_classic_sterimol(mol.CARTESIANS, mol.RADII,mol.ATOMTYPES)
-					elif options.surface == 'density':
-						print("   Can't use classic Sterimol with the isodensity surface. Either use VDW radii (--surface vdw) or use grid Sterimol (--sterimol grid)"); exit()
+					L, Bmax, Bmin, cyl = classic_sterimol
 				Bmin_list.append(Bmin)
 				Bmax_list.append(Bmax)
 				
 				# for pymol visualization
-				for c in cyl:
-					cylinders.append(c)
+				if pymol_output: cylinders.extend(cyl)
 	
 			# Tabulate result
 			if options.volume and options.sterimol:
 				# for pymol visualization
-				spheres.append("   SPHERE, 0.000, 0.000, 0.000, {:5.3f}".format(rad))
+				if pymol_output: spheres.append("   SPHERE, 0.000, 0.000, 0.000, {:5.3f}".format(rad))
 				if not options.quiet: print("   {:6.2f} {:10.2f} {:10.2f} {:10.2f} {:10.2f} {:10.2f}".format(rad, bur_vol, bur_shell, Bmin, Bmax, L))
 			elif options.volume:
-				spheres.append("   SPHERE, 0.000, 0.000, 0.000, {:5.3f}".format(rad))
+				if pymol_output: spheres.append("   SPHERE, 0.000, 0.000, 0.000, {:5.3f}".format(rad))
 				if not options.quiet: print("   {:6.2f} {:10.2f} {:10.2f}".format(rad, bur_vol, bur_shell))
 			elif options.sterimol:
 				if not options.scan:
@@ -431,22 +452,39 @@ class dbstep:
 
 		# recompute L if a scan has been performed to get an overall L
 		if options.measure == 'grid' and r_intervals >1 and options.sterimol:
-			L, Bmax, Bmin, cyl = sterics.get_cube_sterimol(occ_grid, rad, options.grid, 0.0)
+			# over the whole grid L is simply the highest occupied point, no angular sweep is needed
+			L = occ_grid[:,2].max() if len(occ_grid) > 0 else 0
 			if not options.quiet:  print('\n   L parameter is {:5.2f} Ang'.format(L))
 		
-		if options.sterimol: cylinders.append('   CYLINDER, 0., 0., 0., 0., 0., {:5.3f}, 0.1, 1.0, 1.0, 1.0, 0., 0.0, 1.0,'.format(L))
+		if options.sterimol and pymol_output: cylinders.append('   CYLINDER, 0., 0., 0., 0., 0., {:5.3f}, 0.1, 1.0, 1.0, 1.0, 0., 0.0, 1.0,'.format(L))
 		
 		# Stop timing the loop
-		calc_time = time.time() - start - setup_time
+		if options.timing:
+			calc_time = time.perf_counter() - start - setup_time
+			self.setup_time = setup_time
+			self.calc_time = calc_time
 		# Report timing for the whole program and write a PyMol script
 		if options.timing == True and not options.quiet: 
 			print('   Timing: Setup {:5.1f} / Calculate {:5.1f} (secs)'.format(setup_time, calc_time))
-		self.setup_time = setup_time
-		self.calc_time = calc_time
-		if options.commandline == False and ext != 'rdkit':
+		if pymol_output:
 			writer.xyz_export(file,mol)
 			writer.pymol_export(file, mol, spheres, cylinders, options.isoval)
 
+def run_buffered(file, options):
+	"""Runs dbstep on one file in a worker process, returning its printed output so it is not interleaved,
+	whether the calculation stopped the program and the exit code/message if it did"""
+	output = io.StringIO()
+	with redirect_stdout(output):
+		try:
+			dbstep(file, options=options)
+		except SystemExit as e:
+			return output.getvalue(), True, e.code
+		except Exception:
+			# keep what was printed before the failure, the traceback is reported like an exit message
+			return output.getvalue(), True, traceback.format_exc()
+	return output.getvalue(), False, None
+
+
 class options_add:
         pass
 		
@@ -504,6 +542,7 @@ def main():
 	parser.add_option("--commandline", dest="commandline",action="store_true", help="Requests no new files be created", default=False)
 	parser.add_option("--quiet", dest="quiet",action="store_true", help="Requests no print statements to command line", default=False)
 	parser.add_option("--debug", dest="debug", action="store_true", help="Mode for debugging, graph grid points, print extra stuff", default=False, metavar="debug")
+	parser.add_option("--nproc", dest="nproc", action="store", help="Number of processes used to run multiple files in parallel (default = 1)", type=int, default=1, metavar="nproc")
 	(options, args) = parser.parse_args()
 
 	# make sure upper/lower case doesn't matter
@@ -542,9 +581,19 @@ def main():
 			else: dim[i]-=3
 		options.gridsize = str(dim[0])+','+str(dim[1])+':'+str(dim[2])+','+str(dim[3])+':'+str(dim[4])+','+str(dim[5])
 		if options.verbose: print("   Grid size for QSAR mode is: "+options.gridsize)
-	# loop over all specified output files
-	for file in files:
-		dbstep(file,options=options)
+	# loop over all specified output files, in parallel if requested (debug mode always runs serially)
+	if options.nproc > 1 and len(files) > 1 and not options.debug:
+		# workers are spawned rather than forked: the numba threading layer started by the kernel warm-up in sterics does not survive a fork
+		with ProcessPoolExecutor(max_workers=options.nproc, mp_context=multiprocessing.get_context('spawn')) as executor:
+			for output, stopped, code in executor.map(partial(run_buffered, options=options), files):
+				print(output, end='')
+				# stop like the serial loop would, without computing the files that are still queued
+				if stopped:
+					executor.shutdown(wait=False, cancel_futures=True)
+					sys.exit(code)
+	else:
+		for file in files:
+			dbstep(file,options=options)
 
 if __name__ == "__main__":
 	main()
@@ -1,5 +1,5 @@
 # -*- coding: UTF-8 -*-
-import os,sys
+import os,sys,re
 import numpy as np
 import cclib
 
@@ -34,6 +34,29 @@ def element_id(massno, num=False):
 		return "XX"
 
 
+def atom_label(spec):
+	"""Splits an atom specification such as 'C3' or 3 into its element symbol ('' if not given) and atom number"""
+	match = re.match(r'^\s*([A-Za-z]*)(\d+)\s*$', str(spec))
+	if match is None:
+		raise ValueError("Can't read atom specification: {}".format(spec))
+	return match.group(1), int(match.group(2))
+
+
+def remove_hydrogens(mol, spec_atom_1, spec_atom_2):
+	"""Removes hydrogen atoms from a parsed molecule and renumbers the requested atoms (atom numbers start at 1)"""
+	hs = np.flatnonzero(mol.ATOMTYPES == "H")
+	# a requested atom that is removed would otherwise be renumbered onto the next heavy atom
+	for atom in [spec_atom_1] + list(spec_atom_2):
+		if np.isin(atom - 1, hs):
+			sys.exit("   Atom {} is a hydrogen and can't be used with --noH".format(atom))
+	mol.ATOMTYPES = np.delete(mol.ATOMTYPES,hs)
+	mol.CARTESIANS = np.delete(mol.CARTESIANS,hs,0)
+	# each atom moves down by the number of hydrogens that came before it
+	mol.spec_atom_1 = int(spec_atom_1 - np.searchsorted(hs, spec_atom_1))
+	spec_atom_2 = np.asarray(spec_atom_2)
+	mol.spec_atom_2 = [int(atom) for atom in spec_atom_2 - np.searchsorted(hs, spec_atom_2)]
+
+
 class GetCubeData:
 	""" Read data from cube file, obtian XYZ Cartesians, dimensions, and volumetric data """
 	def __init__(self, file):
@@ -137,36 +160,7 @@ class GetXYZData:
 		self.CARTESIANS = np.array(self.CARTESIANS)
 		#remove hydrogens if requested, update spec_atom numbering if necessary
 		if noH:
-			atom1_id,atom2_id = -1,-1
-			for n,atom in enumerate(self.ATOMTYPES):
-				if atom+str(n+1) == spec_atom_1:
-					atom1_id = n
-				elif atom+str(n+1) == spec_atom_2:
-					atom2_id = n
-			hs=[]
-			for n,atom in enumerate(self.ATOMTYPES):
-				if atom == "H":
-					hs.append(n)
-			center_sub,lig_sub = 0,0
-			for n in range(len(hs)):
-				if hs[n] < atom1_id:
-					center_sub -= 1
-				if hs[n] < atom2_id:
-					lig_sub -= 1
-			atom1_id += center_sub
-			atom2_id += lig_sub
-			
-			self.ATOMTYPES = np.delete(self.ATOMTYPES,hs)
-			self.CARTESIANS = np.delete(self.CARTESIANS,hs,0)
-			
-			if atom1_id >= 0: 
-				self.spec_atom_1 = self.ATOMTYPES[atom1_id]+str(atom1_id+1)
-			else:
-				self.spec_atom_1 = False
-			if atom2_id >= 0: 
-				self.spec_atom_2 = self.ATOMTYPES[atom2_id]+str(atom2_id+1)
-			else:
-				self.spec_atom_2 = False
+			remove_hydrogens(self, spec_atom_1, spec_atom_2)
 
 			
 class GetData_cclib:
@@ -193,31 +187,7 @@ class GetData_cclib:
 		
 		#remove hydrogens if requested, update spec_atom numbering if necessary
 		if noH:
-			atom1_id, atom2_id = spec_atom_1, spec_atom_2
-			hs=[]
-			for n,atom in enumerate(self.ATOMTYPES):
-				if atom == "H":
-					hs.append(n)
-			center_sub,lig_sub = 0,0
-			for n in range(len(hs)):
-				if hs[n] < atom1_id:
-					center_sub -= 1
-				if hs[n] < atom2_id:
-					lig_sub -= 1
-			atom1_id += center_sub
-			atom2_id += lig_sub
-			
-			self.ATOMTYPES = np.delete(self.ATOMTYPES,hs)
-			self.CARTESIANS = np.delete(self.CARTESIANS,hs,0)
-			
-			if atom1_id >= 0: 
-				self.spec_atom_1 = atom1_id
-			else:
-				self.spec_atom_1 = False
-			if atom2_id >= 0: 
-				self.spec_atom_2 = atom2_id
-			else:
-				self.spec_atom_2 = False
+			remove_hydrogens(self, spec_atom_1, spec_atom_2)
 	
 	
 class GetData_RDKit:
@@ -253,29 +223,5 @@ class GetData_RDKit:
 		
 		#remove hydrogens if requested, update spec_atom numbering if necessary
 		if noH:
-			atom1_id, atom2_id = spec_atom_1, spec_atom_2
-			hs=[]
-			for n,atom in enumerate(self.ATOMTYPES):
-				if atom == "H":
-					hs.append(n)
-			center_sub,lig_sub = 0,0
-			for n in range(len(hs)):
-				if hs[n] < atom1_id:
-					center_sub -= 1
-				if hs[n] < atom2_id:
-					lig_sub -= 1
-			atom1_id += center_sub
-			atom2_id += lig_sub
-			
-			self.ATOMTYPES = np.delete(self.ATOMTYPES,hs)
-			self.CARTESIANS = np.delete(self.CARTESIANS,hs,0)
-			
-			if atom1_id >= 0: 
-				self.spec_atom_1 = atom1_id
-			else:
-				self.spec_atom_1 = False
-			if atom2_id >= 0: 
-				self.spec_atom_2 = atom2_id
-			else:
-				self.spec_atom_2 = False
+			remove_hydrogens(self, spec_atom_1, spec_atom_2)
 	
\ No newline at end of file
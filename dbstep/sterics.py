@@ -1,8 +1,8 @@
 # -*- coding: UTF-8 -*-
-import sys, math
+import sys, math, itertools
 import numpy as np
-from numba import prange,jit
-import scipy.spatial as spatial	
+from numba import prange,njit
+import scipy.spatial as spatial
 
 
 """
@@ -12,14 +12,59 @@ Computes steric data: L, Bmin, Bmax, Buried Volume
 """
 
 
-@jit
-def parallel_grid_scan(xy_grid, angle):
-	"""angular sweep over grid points to find Bmin"""
-	rmax = 0.0
-	for i in prange(len(xy_grid)):
-		r = xy_grid[i][0]*math.cos(angle)+xy_grid[i][1]*math.sin(angle)
-		if r > rmax:
-				rmax = r
+# edge length (Angstrom) of the cuboid cells used to look up which atoms lie near a grid point
+CELL_SIZE = 1.0
+
+
+@njit(parallel=True, cache=True)
+def occupied_kernel(x_vals, y_vals, z_vals, centers, radii_sq, lo, cell, shape, offsets, members):
+	"""flags points of the grid spanned by x_vals, y_vals and z_vals (z fastest) lying within the radius of any atom
+	(compared as squared distances). Only the atoms listed for the cell containing each point, members[offsets[c]:offsets[c+1]], are tested.
+	Points outside the cells are tested against the nearest cell, which cannot contain any atom that reaches them"""
+	ny, nz = y_vals.shape[0], z_vals.shape[0]
+	occ = np.zeros(x_vals.shape[0] * ny * nz, dtype=np.bool_)
+	for i in prange(x_vals.shape[0]):
+		cx = min(max(int(math.floor((x_vals[i] - lo[0]) / cell)), 0), shape[0] - 1)
+		for j in range(ny):
+			cy = min(max(int(math.floor((y_vals[j] - lo[1]) / cell)), 0), shape[1] - 1)
+			for k in range(nz):
+				cz = min(max(int(math.floor((z_vals[k] - lo[2]) / cell)), 0), shape[2] - 1)
+				c = (cx * shape[1] + cy) * shape[2] + cz
+				n = (i * ny + j) * nz + k
+				for m in range(offsets[c], offsets[c+1]):
+					a = members[m]
+					dx, dy, dz = x_vals[i] - centers[a,0], y_vals[j] - centers[a,1], z_vals[k] - centers[a,2]
+					if dx*dx + dy*dy + dz*dz <= radii_sq[a]:
+						occ[n] = True
+						break
+	return occ
+
+
+@njit(parallel=True, cache=True)
+def count_within_axes(x_vals, y_vals, z_vals, center, R):
+	"""counts the points of the grid spanned by x_vals, y_vals and z_vals lying within a distance R of center"""
+	n, R_sq = 0, R * R
+	for i in prange(x_vals.shape[0]):
+		dx = x_vals[i] - center[0]
+		for j in range(y_vals.shape[0]):
+			dy = y_vals[j] - center[1]
+			for k in range(z_vals.shape[0]):
+				dz = z_vals[k] - center[2]
+				if dx*dx + dy*dy + dz*dz <= R_sq:
+					n += 1
+	return n
+
+
+@njit(parallel=True, cache=True)
+def angular_sweep(xy_grid, angles):
+	"""angular sweep over grid points to find the farthest point in each direction, used for Bmin"""
+	rmax = np.zeros(angles.shape[0])
+	for j in prange(angles.shape[0]):
+		cos, sin = math.cos(angles[j]), math.sin(angles[j])
+		for i in range(xy_grid.shape[0]):
+			r = xy_grid[i,0]*cos + xy_grid[i,1]*sin
+			if r > rmax[j]:
+				rmax[j] = r
 	return rmax
 
 
@@ -29,6 +74,19 @@ def grid_round(x, spacing):
 	return(round(x*n)/n)
 
 
+def make_grid(x_vals, y_vals, z_vals):
+	"""Builds a C-contiguous (N,3) array of grid points from the values along each axis.
+	Z varies fastest, matching the ordering of volumetric data in cube files"""
+	grid = np.stack(np.meshgrid(x_vals, y_vals, z_vals, indexing='ij'), axis=-1).reshape(-1, 3)
+	return np.ascontiguousarray(grid, dtype=np.float64)
+
+
+def grid_points(x_vals, y_vals, z_vals, idx):
+	"""Returns the (N,3) coordinates of the points with flat indices idx in the grid spanned by x_vals, y_vals and z_vals"""
+	i, j, k = np.unravel_index(idx, (len(x_vals), len(y_vals), len(z_vals)))
+	return np.column_stack((x_vals[i], y_vals[j], z_vals[k]))
+
+
 def max_dim(coords, radii, options):
 	"""Establishes the smallest cuboid that contains all of the molecule, 
 	if volume is requested, make sure sphere fits fully inside space"""
@@ -74,28 +132,34 @@ def max_dim(coords, radii, options):
 	return [x_min, x_max, y_min, y_max, z_min, z_max, max_dim]
 
 
-def occupied(grid, coords, radii, origin, options):
-	"""Uses atomic coordinates and VDW radii to establish which grid voxels are occupied"""
+def occupied(grid_axes, coords, radii, origin, options, radii_sq=None):
+	"""Uses atomic coordinates and VDW radii to establish which voxels of the grid spanned by grid_axes (x_vals, y_vals, z_vals) are occupied.
+	The grid points are generated inside the kernel, only the occupied (and in QSAR mode unoccupied) points are stored.
+	Squared radii can be passed in if they have already been computed"""
+	assert np.shape(coords)[-1] == 3, "coordinates must have shape (N,3)"
+	x_vals, y_vals, z_vals = [np.asarray(vals, dtype=np.float64) for vals in grid_axes]
 	spacing = options.grid
 	if options.verbose ==True: print("\n   Using a Cartesian grid-spacing of {:5.4f} Angstrom.".format(spacing))
-	if options.verbose ==True: print("   There are {} grid points.".format(len(grid)))
+	if options.verbose ==True: print("   There are {} grid points.".format(len(x_vals) * len(y_vals) * len(z_vals)))
 	
-	idx =  [] 
-	point_tree = spatial.cKDTree(grid,balanced_tree=False,compact_nodes=False)
-	for n in range(len(coords)):
-		center = coords[n] + origin
-		idx.append(point_tree.query_ball_point(center, radii[n], n_jobs=-1))
+	# divide the space around the molecule into cuboid cells and use a KD-tree of the atoms to list,
+	# for each cell, the atoms whose spheres can reach it. Grid points are then only tested against these atoms
+	centers, radii = np.asarray(coords, dtype=np.float64) + origin, np.asarray(radii, dtype=np.float64)
+	if radii_sq is None: radii_sq = radii ** 2
+	lo = centers.min(axis=0) - radii.max()
+	shape = np.floor((centers.max(axis=0) + radii.max() - lo) / CELL_SIZE).astype(np.int64) + 1
+	cell_centers = make_grid(*[lo[i] + (np.arange(shape[i]) + 0.5) * CELL_SIZE for i in range(3)])
+	atom_tree = spatial.cKDTree(centers)
+	neighbours = atom_tree.query_ball_point(cell_centers, math.sqrt(3) * CELL_SIZE + radii.max(), return_sorted=False)
+	offsets = np.zeros(len(neighbours) + 1, dtype=np.int64)
+	offsets[1:] = np.cumsum(np.fromiter(map(len, neighbours), dtype=np.int64, count=len(neighbours)))
+	members = np.fromiter(itertools.chain.from_iterable(neighbours), dtype=np.int64, count=offsets[-1])
+	occ = occupied_kernel(x_vals, y_vals, z_vals, centers, radii_sq, lo, CELL_SIZE, shape, offsets, members)
 	#construct a list of indices of the grid array that are occupied / unoccupied
-	jdx = [y for x in idx for y in x]
-	if options.qsar: kdx = [i for i in range(len(grid)) if i not in jdx] 
-	
-	# removes duplicates since a voxel can only be occupied once
-	jdx = list(set(jdx))
+	jdx = np.flatnonzero(occ)
 	if options.qsar: 
-		kdx = list(set(kdx))
-		onehot = np.zeros(len(grid))
-		for i in jdx:
-			onehot[i] = 1.
+		kdx = np.flatnonzero(~occ)
+		onehot = occ.astype(np.uint8)
 	
 	if options.verbose: print("   There are {} occupied grid points.".format(len(jdx)))
 	occ_vol = len(jdx) * spacing ** 3
@@ -104,31 +168,33 @@ def occupied(grid, coords, radii, origin, options):
 	if options.debug:
 		#visualize grid points quickly
 		import pptk
-		u = pptk.viewer(grid)
-		v = pptk.viewer(grid[jdx])
-		if options.qsar: w = pptk.viewer(grid[kdx])
+		u = pptk.viewer(make_grid(x_vals, y_vals, z_vals))
+		v = pptk.viewer(grid_points(x_vals, y_vals, z_vals, jdx))
+		if options.qsar: w = pptk.viewer(grid_points(x_vals, y_vals, z_vals, kdx))
 	
 	if options.qsar:
-		return grid[jdx],grid[kdx],onehot,point_tree
+		return grid_points(x_vals, y_vals, z_vals, jdx),grid_points(x_vals, y_vals, z_vals, kdx),onehot,occ_vol
 	else:
-		return grid[jdx],point_tree,occ_vol
+		return grid_points(x_vals, y_vals, z_vals, jdx),occ_vol
 
 
-def occupied_dens(grid, dens, options):
-	"""Uses density cube to establish which grid voxels are occupied (i.e. density is above some isoval, by default 0.002)"""
+def occupied_dens(grid_axes, dens, options, rotation=None):
+	"""Uses density cube to establish which grid voxels are occupied (i.e. density is above some isoval, by default 0.002).
+	The density is ordered like the grid spanned by grid_axes (x_vals, y_vals, z_vals), only occupied points are given coordinates.
+	If the molecule has been rotated, the same rotation matrix must be given so the points are returned in the rotated frame"""
 	spacing, isoval = options.grid, options.isoval
-	cube, list = (spacing / 0.529177249) ** 3, []
 	if options.verbose: print("\n   Using a Cartesian grid-spacing of {:5.4f} Angstrom".format(spacing))
 
-	for n, density in enumerate(dens):
-		if density > isoval: list.append(n)
-	occ_vol = len(list) * spacing ** 3
+	jdx = np.flatnonzero(np.asarray(dens).reshape(-1) > isoval)
+	occ_vol = len(jdx) * spacing ** 3
 	if options.verbose: print("   Molecular volume is {:5.4f} Ang^3".format(occ_vol))
-	return grid[list],occ_vol
+	occ_grid = grid_points(*grid_axes, jdx)
+	if rotation is not None: occ_grid = occ_grid @ rotation.T
+	return occ_grid,occ_vol
 
 
 def resize_grid(x_max,y_max,z_max,x_min,y_min,z_min,options,mol):
-	"""Resize the grid to accomodate the sphere for volume calculations"""
+	"""Resize the grid to accomodate the sphere for volume calculations, returns the values along each axis"""
 	if x_max < options.radius+options.radius*0.1: 
 		x_orig = x_max
 		x_max = options.radius+options.radius*0.1
@@ -175,9 +241,8 @@ def resize_grid(x_max,y_max,z_max,x_min,y_min,z_min,options,mol):
 	x_vals = np.linspace(x_min, x_max, mol.xdim)
 	y_vals = np.linspace(y_min, y_max, mol.ydim)
 	z_vals = np.linspace(z_min, z_max, mol.zdim)
-	grid = np.array(np.meshgrid(x_vals, y_vals, z_vals)).T.reshape(-1,3)
 	
-	return grid
+	return x_vals, y_vals, z_vals
 	
 
 def get_classic_sterimol(coords, radii, atoms):
@@ -243,31 +308,43 @@ def get_classic_sterimol(coords, radii, atoms):
 	return L, Bmax, Bmin, cyl
 
 
-def get_cube_sterimol(occ_grid, R, spacing, strip_width, measure_pos=False):
+def height_order(occ_grid):
+	"""Indices sorting the occupied grid points by height (Z) together with the sorted heights,
+	so that each strip of a Sterimol scan can be found with a binary search"""
+	order = np.argsort(occ_grid[:,2], kind='stable')
+	return order, occ_grid[order,2]
+
+
+def get_cube_sterimol(occ_grid, R, spacing, strip_width, measure_pos=False, z_order=None):
 	"""Uses grid occupancy to define Sterimol L, B1 and B5 parameters. If the grid-spacing is small enough this should be close to the
 	conventional values above when the grid occupancy is based on VDW radii. The real advantage is that the isodensity surface can be used,
 	which does not require VDW radii, and this also looks something a bit closer to a solvent-accessible surface than the sum-of-spheres.
 	Also B1 can be defined in a physically more # meaningful way than the traditional approach. This method can take horizontal slices to
-	evaluate these parameters along the L-axis, which is also a nightmare with the conventional definition."""
+	evaluate these parameters along the L-axis, which is also a nightmare with the conventional definition.
+	When scanning, the output of height_order can be passed in as z_order to avoid testing every point for each strip."""
 	
 	L, Bmax, Bmin, xmax, ymax, zmax, xmin, ymin, cyl = 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, []
 
 	# this is a layer of the occupancy grid between Z-limits
-	if strip_width != 0: 
-		xy_grid = np.array([(x,y,z) for x,y,z in occ_grid if z <= R + strip_width and z > R - strip_width])
+	if strip_width != 0 and z_order is not None:
+		# points with R - strip_width < z <= R + strip_width, kept in their original order
+		order, z = z_order
+		strip = order[np.searchsorted(z, R - strip_width, side='right'):np.searchsorted(z, R + strip_width, side='right')]
+		xy_grid = occ_grid[np.sort(strip)]
+	elif strip_width != 0: 
+		xy_grid = occ_grid[(occ_grid[:,2] <= R + strip_width) & (occ_grid[:,2] > R - strip_width)]
 	else: 
 		xy_grid = occ_grid
 	
 	if measure_pos:
-		xy_grid = np.array([(x,y,z) for x,y,z in occ_grid if z >= 0])
+		xy_grid = occ_grid[occ_grid[:,2] >= 0]
 
 	if len(xy_grid) > 0:
-		#radii = map(lambda x: math.sqrt(x[0]**2+x[1]**2), xy_grid)
-		radii = [math.sqrt(x**2+y**2) for x,y,z in xy_grid]
-		Bmax, imax = max(radii), np.argmax(radii)
+		radii = np.sqrt(xy_grid[:,0]**2 + xy_grid[:,1]**2)
+		imax = np.argmax(radii)
+		Bmax = radii[imax]
 		xmax, ymax, zmax = xy_grid[imax]
-		#print(Bmax, math.sqrt(xmax**2+ymax**2))
-		L = max(map(lambda x: x[2], xy_grid))
+		L = xy_grid[:,2].max()
 
 		# Go around in angle increments and record the farthest out point in each slice
 		increments = 361
@@ -275,17 +352,13 @@ def get_cube_sterimol(occ_grid, R, spacing, strip_width, measure_pos=False):
 
 		Bmin = sys.float_info.max
 		xmin,ymin = 0,0
-		max_r, max_phi = [], []
-
-		for angle in angles:
-			rmax = parallel_grid_scan(xy_grid,angle)
+		rmax = angular_sweep(np.ascontiguousarray(xy_grid), angles)
 
-			if rmax != 0.0: # by definition can't have zero radius
-				max_r.append(rmax)
-				max_phi.append(angle)
+		# by definition can't have zero radius
+		max_r, max_phi = rmax[rmax != 0.0], angles[rmax != 0.0]
 
 		if len(max_r) > 0:
-			Bmin = min(max_r)
+			Bmin = max_r.min()
 			xmin, ymin = Bmin * math.cos(max_phi[np.argmin(max_r)]), Bmin * math.sin(max_phi[np.argmin(max_r)])
 
 	elif len(xy_grid) == 0:
@@ -303,9 +376,19 @@ def get_cube_sterimol(occ_grid, R, spacing, strip_width, measure_pos=False):
 	return L, Bmax, Bmin, cyl
 
 
-def buried_vol(occ_grid, point_tree, origin, rad, strip_width, options):
-	""" Read which grid points occupy sphere"""
+def occupied_dist_sq(occ_grid, origin):
+	"""Sorted squared distances of the occupied grid points from the origin, so that the number of
+	occupied points inside any sphere around the origin can be found with a binary search"""
+	d = occ_grid - origin
+	return np.sort(d[:,0]*d[:,0] + d[:,1]*d[:,1] + d[:,2]*d[:,2])
+
+
+def buried_vol(occ_grid, grid_axes, origin, rad, strip_width, options, occ_dist_sq=None):
+	""" Read which grid points occupy sphere. The full grid is given by the values along each axis (x_vals, y_vals, z_vals).
+	When many radii are evaluated, the sorted squared distances of the occupied points can be computed once and passed in"""
 	verbose = options.verbose
+	origin = np.asarray(origin, dtype=np.float64)
+	if occ_dist_sq is None: occ_dist_sq = occupied_dist_sq(occ_grid, origin)
 	
 	#if doing a scan, use scan radius for volume
 	if strip_width != 0.0: R = rad
@@ -316,11 +399,10 @@ def buried_vol(occ_grid, point_tree, origin, rad, strip_width, options):
 	cube = spacing ** 3 # cube 
 	
 	# Find total points in the grid within a sphere radius R
-	n_voxel = len(point_tree.query_ball_point(origin, R))
+	n_voxel = count_within_axes(*grid_axes, origin, R)
 	tot_vol = n_voxel * cube
 	# Find occupied points within the same spherical volume
-	point_tree = spatial.cKDTree(occ_grid,balanced_tree=False,compact_nodes=False)
-	n_occ = len(point_tree.query_ball_point(origin, R, n_jobs=-1))
+	n_occ = np.searchsorted(occ_dist_sq, R * R, side='right')
 	occ_vol = n_occ * cube
 	free_vol = tot_vol - occ_vol 
 	percent_buried_vol = occ_vol / tot_vol * 100.0
@@ -333,22 +415,17 @@ def buried_vol(occ_grid, point_tree, origin, rad, strip_width, options):
 	# along the L-axis is being performed
 	if strip_width != 0.0:
 		shell_vol = 4 / 3 * math.pi * ((R + 0.5 * strip_width) ** 3 - (R - 0.5 * strip_width) ** 3)
-		point_tree = spatial.cKDTree(occ_grid,balanced_tree=False,compact_nodes=False)
 		R_pos = R + 0.5 * strip_width
 		if R < strip_width: 
 			R_neg = 0.0
 		else:
 			R_neg = R - 0.5 * strip_width
-		shell_occ = len(point_tree.query_ball_point(origin, R_pos, n_jobs=-1)) - len(point_tree.query_ball_point(origin, R_neg, n_jobs=-1))
+		shell_occ = np.searchsorted(occ_dist_sq, R_pos * R_pos, side='right') - np.searchsorted(occ_dist_sq, R_neg * R_neg, side='right')
 		if options.debug:
 			# this may take a while
 			import pptk
-			a = point_tree.query_ball_point(origin,R_pos , n_jobs=-1)
-			b = point_tree.query_ball_point(origin,R_neg, n_jobs=-1)
-			for pt in b:
-				if pt in a:
-					a.remove(pt)
-			u = pptk.viewer(occ_grid[a])
+			dist = np.linalg.norm(occ_grid - origin, axis=1)
+			u = pptk.viewer(occ_grid[(dist <= R_pos) & (dist > R_neg)])
 		shell_occ_vol = shell_occ * cube
 		percent_shell_vol = shell_occ_vol / shell_vol * 100.0
 	else: percent_shell_vol = 0.0
@@ -365,4 +442,9 @@ def buried_vol(occ_grid, point_tree, origin, rad, strip_width, options):
 	if abs(vol_err) > 5.0:
 		print("   WARNING! {:5.2f}% error in estimating the exact spherical volume. The grid spacing is probably too big in relation to the sphere volume".format(vol_err))
 	
-	return percent_buried_vol, percent_shell_vol
\ No newline at end of file
+	return percent_buried_vol, percent_shell_vol
+
+# compile the kernels on import so that JIT compilation is not counted in the timings of a calculation
+occupied_kernel(np.zeros(1), np.zeros(1), np.zeros(1), np.zeros((1,3)), np.ones(1), np.zeros(3), CELL_SIZE, np.ones(3, dtype=np.int64), np.array([0, 1], dtype=np.int64), np.zeros(1, dtype=np.int64))
+count_within_axes(np.zeros(1), np.zeros(1), np.zeros(1), np.zeros(3), 1.0)
+angular_sweep(np.zeros((1,3)), np.zeros(1))